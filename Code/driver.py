@@ -17,6 +17,7 @@ import zipfile
 import shutil
 import imageio
 import warnings
+from functools import partial
 from openpyxl import load_workbook
 
 def save_ToF_histogram(name, data_set, coincident_events, 
@@ -370,17 +371,71 @@ def choose_data_set():
     ans = input('>> ')
     
     max_size = np.inf
+    sample_step = None
+    sample_fraction = None
     if ans == 'n':
-        print('Enter amount of data in MB to import (minimum size is 1 MB).')
-        max_size = input('>> ')
-        max_size = int(max_size)
+        print('    1. Import beginning of file(s)')
+        print('    2. Import every Nth readout')
+        print('    3. Import random fraction of readouts')
+        print('Enter a number between 1-3.')
+        sample_ans = input('>> ')
+        sample_ans = int(sample_ans)
+        if sample_ans == 1:
+            print('Enter amount of data in MB to import (minimum size is 1 MB).')
+            max_size = input('>> ')
+            max_size = int(max_size)
+        elif sample_ans == 2:
+            sample_step = input('N: ')
+            sample_step = int(sample_step)
+        else:
+            sample_fraction = input('Fraction (0 minimum, 1 maximum): ')
+            sample_fraction = float(sample_fraction)
+    
+    time_window = None
+    memory_map = False
+    if sample_step is not None or sample_fraction is not None:
+        print('Sampled readouts are read in chunks from the whole file, a '
+              + 'time-stamp\nwindow and memory-mapping can not be used.')
+    else:
+        print('Import only a time-stamp window (y/n)?')
+        window_ans = input('>> ')
+        if window_ans == 'y':
+            min_ts = input('Minimum timestamp: ')
+            max_ts = input('Maximum timestamp: ')
+            time_window = [int(min_ts), int(max_ts)]
+        
+        print('Memory-map file(s) instead of reading them into memory (y/n)?')
+        map_ans = input('>> ')
+        if map_ans == 'y':
+            memory_map = True
+    
+    parallel = False
+    prefetch = False
+    if len(data_sets) > 1:
+        print('Cluster files in parallel, one process per file (y/n)?')
+        parallel_ans = input('>> ')
+        if parallel_ans == 'y':
+            parallel = True
+    if len(data_sets) > 1 and not parallel:
+        print('Import next file in the background while clustering (y/n)?')
+        prefetch_ans = input('>> ')
+        if prefetch_ans == 'y':
+            prefetch = True
     
     discard_glitch = False
+    discard_glitches = False
     print('Discard glitch events (y/n)?')
     glitch_ans = input('>> ')
     glitch_mid = np.ones(number_of_files) * 0.5
     if glitch_ans == 'y':
-        discard_glitch = True
+        print('Discard glitches anywhere in the run, not only at the start '
+              + 'and end (y/n)?')
+        anywhere_ans = input('>> ')
+        if anywhere_ans == 'y':
+            discard_glitches = True
+        else:
+            discard_glitch = True
+    if discard_glitch:
         print('Change glitch mid (y/n)?')
         glitch_mid_ans = input('>> ')
         if glitch_mid_ans == 'y':
@@ -393,122 +448,102 @@ def choose_data_set():
     keep_only_ce = False
     if ce_ans == 'y':
         keep_only_ce = True 
-    print('Enter incident neutron energy E_i:')
-    E_i = input('E_i [meV]: ')
-    E_i = float(E_i)
-    print(E_i)
-    
-    print('Choose calibration: ')
-    calibrations =  ['High_Resolution', 'High_Flux', 'RRM']
-    for i, calibration in enumerate(calibrations):
-        print('    ' + str(i+1) + '. ' + calibration)
-    print('Enter a number between 1-3.')
-    selection = input('>> ')
-    selection = int(selection)
-    calibration = calibrations[selection-1]
-    calibration = 'Van__3x3_' + calibration + '_Calibration_' + str(E_i)
-    
     
-    coincident_events = pd.DataFrame()
-    events = pd.DataFrame()
-    triggers = pd.DataFrame()
+    print('Choose clustering engine: ')
+    engines = ['loop', 'vectorized', 'jit', 'window']
+    print('    1. Loop over words')
+    print('    2. Vectorized')
+    print('    3. Compiled loop (requires Numba)')
+    print('    4. Time window, for triggerless runs')
+    print('Enter a number between 1-4.')
+    engine_ans = input('>> ')
+    engine = engines[int(engine_ans) - 1]
+    cluster_function = clu.get_cluster_function(engine)
+    if engine == 'window':
+        print('Enter coincidence window in time stamps (62.5 ns): ')
+        coincidence_window = int(input('>> '))
+        cluster_function = partial(clu.cluster_data_time_window,
+                                   coincidence_window=coincidence_window)
+    elif not parallel:
+        print('Split each file across all cores (y/n)?')
+        shard_ans = input('>> ')
+        if shard_ans == 'y':
+            cluster_function = partial(clu.cluster_data_sharded, engine=engine)
+    E_i, calibration = choose_E_i_and_calibration()
+    print('Add energy transfer columns dE, tf and ToF_real (y/n)?')
+    energy_transfer_ans = input('>> ')
+    
+    
+    ce_list = []
+    e_list = []
+    t_list = []
+    number_ce = 0
+    number_events = 0
+    number_triggers = 0
     measurement_time = 0
     total_duration = 0
-    for i, data_set in enumerate(data_sets):
-        # Declare normalisation parameters
-        
+    glitch_mids = [None for data_set in data_sets]
+    if discard_glitch:
+        glitch_mids = glitch_mid
+    
+    if parallel:
+        import_options = {'max_size': max_size, 'memory_map': memory_map,
+                          'time_window': time_window, 
+                          'sample_step': sample_step,
+                          'sample_fraction': sample_fraction}
+        results = clu.cluster_files_parallel(data_sets, exceptions, E_i,
+                                             calibration, import_options,
+                                             glitch_mids, not keep_only_ce,
+                                             engine=cluster_function,
+                                             discard_glitches=discard_glitches)
+    else:
+        states = [{} for data_set in data_sets]
+        if sample_step is not None or sample_fraction is not None:
+            imported_data = (sample_data_set(data_set, sample_step, 
+                                             sample_fraction)
+                             for data_set in data_sets)
+        elif prefetch:
+            imported_data = ((data, 1) for data in 
+                             clu.import_data_prefetch(data_sets, max_size, 
+                                                      memory_map, time_window,
+                                                      states))
+        else:
+            imported_data = ((clu.import_data(data_set, max_size, memory_map,
+                                              time_window, None, state), 1)
+                             for data_set, state in zip(data_sets, states))
+        results = cluster_imported_data(imported_data, states, glitch_mids,
+                                        cluster_function, exceptions, E_i,
+                                        calibration, not keep_only_ce,
+                                        discard_glitches)
+    
+    for i, (ce, e, t, duration, live_time) in enumerate(results):
         print()
         print('-- File ' + str(i+1) + '/' + str(len(data_sets)) + ' --')
-        data_temp = clu.import_data(data_set, max_size)
-        ce_temp, e_temp, t_temp = clu.cluster_data(data_temp, exceptions, E_i,
-                                                   calibration)
-        temp_duration = 0
+        total_duration += duration
+        measurement_time += live_time
+        print('Total duration: ' + str(total_duration))
+        print('Measurement time: ' + str(measurement_time))
         
-        if discard_glitch:
-            ce = ce_temp
-            e = e_temp
-            ce_red = ce[(ce['wM'] >= 80) & (ce['gM'] >= 40)]
-            if len(ce_red.index) == 0:
-                total_duration += ( ce.tail(1)['Time'].values[0]
-                                   -ce.head(1)['Time'].values[0] ) * 62.5e-9
-                print('total_duration' + str(total_duration))
-                
-                temp_duration = ( ce.tail(1)['Time'].values[0]
-                                 -ce.head(1)['Time'].values[0] ) * 62.5e-9
-            else:
-                # Filter glitch events in begining and end by diving data
-                # in two parts (f: first, s: second) and finding first 
-                # and last glitch event.
-                
-                mid_point = ce.tail(1)['Time'].values[0] * glitch_mid[i]
-                ce_f = ce_temp[(ce_temp['Time'] < mid_point)]
-                ce_s = ce_temp[(ce_temp['Time'] > mid_point)]
-                ce_red_f = ce_f[(ce_f['wM'] >= 80) & (ce_f['gM'] >= 40)]
-                ce_red_s = ce_s[(ce_s['wM'] >= 80) & (ce_s['gM'] >= 40)]
-                
-                data_start = None
-                data_end = None
-                if ce_red_f.shape[0] > 0:
-                    data_start = ce_red_f.tail(1)['Time'].values[0]
-                else:
-                    data_start = ce.head(1)['Time'].values[0]
-                
-                
-                if ce_red_s.shape[0] > 0:
-                    data_end = ce_red_s.head(1)['Time'].values[0]
-                else:
-                    data_end = ce.tail(1)['Time'].values[0]
-                
-                temp_duration = ( ce.tail(1)['Time'].values[0]
-                                 -ce.head(1)['Time'].values[0] ) * 62.5e-9
-                
-                total_duration += ( ce.tail(1)['Time'].values[0]
-                                   -ce.head(1)['Time'].values[0] ) * 62.5e-9
-                print('total_duration' + str(total_duration))
-
-                ce = ce_temp[  (ce_temp['Time'] > data_start)
-                             & (ce_temp['Time'] < data_end)]
-
-                e = e_temp[  (e_temp['Time'] > data_start)
-                           & (e_temp['Time'] < data_end)]
-            
-            
-            # Temp line to save ToF histograms
-            print('Temp duration: ' + str(temp_duration))
-           # save_ToF_histogram(data_set, data_set, ce, temp_duration)
-            
-            
-            start_time = 0
-            end_time = 0
-            if ce.shape[0] > 0:
-                start_time = ce.head(1)['Time'].values[0]
-                end_time = ce.tail(1)['Time'].values[0]
-            
-            coincident_events = coincident_events.append(ce)
-            if not keep_only_ce:
-                events = events.append(e)
-            measurement_time += (end_time - start_time) * 62.5e-9
-            
-            # Save relevant numbers to calculate charge norm
-            
-            print('Measurement time: ' + str(measurement_time))
-            print('Total time: ')
-        else:
-            start_time = ce_temp.head(1)['Time'].values[0]
-            end_time = ce_temp.tail(1)['Time'].values[0]
-            measurement_time += (end_time - start_time) * 62.5e-9
-            total_duration += ( ce_temp.tail(1)['Time'].values[0]
-                               -ce_temp.head(1)['Time'].values[0] ) * 62.5e-9
-            coincident_events = coincident_events.append(ce_temp)
-            if not keep_only_ce:
-                events = events.append(e_temp)
-                
-
-        triggers = triggers.append(t_temp)
+        if not keep_only_ce:
+            e_list.append(clu.shift_cluster_ids(e, number_ce))
+            number_events += e.shape[0]
+        ce_list.append(ce)
+        number_ce += ce.shape[0]
+        t_list.append(t)
+        number_triggers += t.shape[0]
         #save_charge_norm(total_duration, measurement_time, calibration, number_of_files)
             
-        print('len(e): ' + str(events.shape[0]))
-        print('len(triggers): ' + str(triggers.shape[0]))
+        print('len(e): ' + str(number_events))
+        print('len(triggers): ' + str(number_triggers))
+    
+    coincident_events = pd.DataFrame()
+    events = pd.DataFrame()
+    triggers = pd.DataFrame()
+    if len(ce_list) > 0:
+        coincident_events = pd.concat(ce_list)
+        triggers = pd.concat(t_list)
+    if len(e_list) > 0:
+        events = pd.concat(e_list)
                 
     if len(data_sets) < 2:
         pass
@@ -520,6 +555,9 @@ def choose_data_set():
     coincident_events.reset_index(drop=True, inplace=True)
     events.reset_index(drop=True, inplace=True)
     triggers.reset_index(drop=True, inplace=True)
+    if energy_transfer_ans == 'y':
+        coincident_events = clu.add_energy_transfer(coincident_events, E_i,
+                                                    calibration)
     
     
     
@@ -529,6 +567,127 @@ def choose_data_set():
             number_of_detectors, module_order, detector_types, 
             measurement_time, E_i, calibration)
 
+def cluster_imported_data(imported_data, states, glitch_mids, 
+                          cluster_function, exceptions, E_i, calibration,
+                          keep_events, discard_glitches):
+    for (data, sampled_fraction), state, glitch_mid in zip(imported_data, 
+                                                           states, 
+                                                           glitch_mids):
+        clusters = cluster_function(data, exceptions, E_i, calibration, state,
+                                    keep_events)
+        # Drop the words before the next file is imported, so that
+        # 'clu.import_data_prefetch' holds at most two files in memory
+        del data
+        yield clu.finish_clusters(*clusters, sampled_fraction, glitch_mid,
+                                  keep_events, discard_glitches)
+
+
+def sample_data_set(data_set, sample_step, sample_fraction):
+    data, sampled_fraction = clu.import_data_sample(data_set, sample_step,
+                                                    sample_fraction)
+    print('Kept ' + str(round(sampled_fraction*100, 2)) + '% of readouts')
+    return data, sampled_fraction
+
+
+def choose_E_i_and_calibration():
+    print('Enter incident neutron energy E_i:')
+    E_i = input('E_i [meV]: ')
+    E_i = float(E_i)
+    print(E_i)
+    
+    print('Choose calibration: ')
+    calibrations =  ['High_Resolution', 'High_Flux', 'RRM']
+    for i, calibration in enumerate(calibrations):
+        print('    ' + str(i+1) + '. ' + calibration)
+    print('Enter a number between 1-3.')
+    selection = input('>> ')
+    selection = int(selection)
+    calibration = calibrations[selection-1]
+    calibration = 'Van__3x3_' + calibration + '_Calibration_' + str(E_i)
+    return E_i, calibration
+
+def follow_data_set(source):
+    statistics = {}
+    if source == 'f':
+        print()
+        print('************ Choose a file to follow ************')
+        print('-------------------------------------------------')
+        for i, file in enumerate(files):
+            print(str(i+1) + '. ' + str(file))
+        file_number = input('\nEnter a number between 1-' + str(len(files)) 
+                            + '.\n>> ')
+        data_set = files[int(file_number) - 1]
+    else:
+        port = input('Port: ')
+        port = int(port)
+        protocol = input('Protocol (tcp/udp): ')
+        data_set = 'Socket_' + protocol + '_' + str(port)
+    
+    print('Use standard module order and detector types (y/n)?')
+    answer = input('>> ')
+    if answer == 'y':
+        number_of_detectors = 3
+        module_order = [0,1,2,3,4,5,6,7,8]
+        detector_types = ['ILL', 'ESS', 'ESS']
+        exceptions = [0,1,2]
+    else:
+        number_of_detectors, module_order = choose_number_modules()
+        detector_types, exceptions = initialise_detector_types(number_of_detectors)
+        print()
+    
+    E_i, calibration = choose_E_i_and_calibration()
+    
+    if source == 'f':
+        chunks = clu.follow_data(data_set)
+    else:
+        chunks = clu.receive_data(port, protocol=protocol, 
+                                  statistics=statistics)
+    
+    print('Following ' + data_set + '... Press Ctrl+C to stop.')
+    ce_list = []
+    e_list = []
+    number_ce = 0
+    t_list = []
+    histograms = clu.create_histograms()
+    try:
+        for ce, e, t in clu.cluster_stream(chunks, exceptions, E_i, 
+                                           calibration):
+            e_list.append(clu.shift_cluster_ids(e, number_ce))
+            ce_list.append(ce)
+            number_ce += ce.shape[0]
+            t_list.append(t)
+            clu.update_histograms(histograms, ce, e)
+            events_per_bus = histograms['Channel'].sum(axis=1)
+            coincidences_per_bus = histograms['Coincidence'].sum(axis=(1, 2))
+            print('-------------------------------------------------')
+            for bus in module_order:
+                print('Bus ' + str(bus) + ': ' + str(events_per_bus[bus]) 
+                      + ' events, ' + str(coincidences_per_bus[bus]) 
+                      + ' coincident events')
+            if source == 's':
+                print('Received words: ' + str(statistics['Received'])
+                      + ', dropped words: ' + str(statistics['Dropped']))
+    except KeyboardInterrupt:
+        print('\nStopped following ' + data_set)
+    
+    coincident_events = pd.DataFrame()
+    events = pd.DataFrame()
+    triggers = pd.DataFrame()
+    if len(ce_list) > 0:
+        coincident_events = pd.concat(ce_list, ignore_index=True)
+        events = pd.concat(e_list, ignore_index=True)
+        triggers = pd.concat(t_list, ignore_index=True)
+    
+    measurement_time = 0
+    if coincident_events.shape[0] > 0:
+        start_time = coincident_events.head(1)['Time'].values[0]
+        end_time = coincident_events.tail(1)['Time'].values[0]
+        measurement_time = (end_time - start_time) * 62.5e-9
+    
+    return (coincident_events, events, str([data_set]), triggers, 
+            number_of_detectors, module_order, detector_types, 
+            measurement_time, E_i, calibration)
+
 def choose_number_modules():
     modules = [0,1,2,3,4,5,6,7,8]
     not_int = True
@@ -653,6 +812,7 @@ def choose_analysis_type(module_order, data_set, E_i, measurement_time,
                     count_range = specs['Count range']
                 
             print('Loading...')
+            temp_events = clu.partition_by_bus(temp_events)
             fig, path = pl.plot_PHS_buses(fig, name, temp_events, buses, 
                                           data_set, count_range=count_range)
  
@@ -887,7 +1047,10 @@ def choose_analysis_type(module_order, data_set, E_i, measurement_time,
                                      maxGM, exclude_channels, ts_range)
             else:
                 print('Loading...')
-                fig, path = pl.plot_charge_scatter_buses(fig, name, coincident_events, module_order, 
+                fig, path = pl.plot_charge_scatter_buses(fig, name, 
+                                             clu.partition_by_bus(
+                                                     coincident_events),
+                                             module_order, 
                                              number_of_detectors, data_set)
             print('Done!')
 
@@ -1107,7 +1270,7 @@ def choose_analysis_type(module_order, data_set, E_i, measurement_time,
                 for choice in choices:
                     file_name = clu_files[choice-1]
                     clu_path = clusters_folder + file_name
-                    df_temp = pd.read_hdf(clu_path, 'coincident_events')
+                    df_temp = clu.read_clusters(clu_path, 'coincident_events')
                     E_i_temp = pd.read_hdf(clu_path, 'E_i')['E_i'].iloc[0]
                     df_vec.append(df_temp)
                     E_i_vec.append(E_i_temp)
@@ -1266,13 +1429,14 @@ def choose_analysis_type(module_order, data_set, E_i, measurement_time,
         if analysis_type == len(analysis_name_vec)+1:
             if len(figs) > 0:
                 plt.show()
-                print('\nSaving...')
+                progress = clu.create_progress('Saving', len(figs), 
+                                               'figures')
                 count = 1
-                print('0%')
                 for fig, path in zip(figs, paths):
                     fig.savefig(path, bbox_inches='tight')
-                    print(str(round((float(count)/len(figs))*100)) + '%')
+                    clu.update_progress(progress, count)
                     count += 1
+                clu.finish_progress(progress)
                 finished_with_analysis = True
             else:
                 print('\nNothing to plot yet!')
@@ -1328,21 +1492,35 @@ def main_meny(data_sets):
 
 def save_clusters(coincident_events, events, triggers, number_of_detectors,
                   module_order, detector_types, data_set, measurement_time, 
-                  E_i, calibration):
-    print('Saving...')
-    print('0%')
+                  E_i, calibration, buses_per_part = None):
+    progress = clu.create_progress('Saving', 4, 'tables')
+    number_events = coincident_events.shape[0]
     dirname = os.path.dirname(__file__)
     folder = os.path.join(dirname, '../Clusters/')
     path = folder + data_set + '.h5'
     
-    coincident_events.to_hdf(path, 'coincident_events', complevel = 9)
-    print('25%')
-    events.to_hdf(path, 'events', complevel = 9)
-    print('50%')
+    if buses_per_part is None:
+        clu.remove_clusters(path, 'coincident_events')
+        clu.remove_clusters(path, 'events')
+        coincident_events.to_hdf(path, 'coincident_events', complevel = 9)
+        clu.update_progress(progress, 1, events = number_events)
+        events.to_hdf(path, 'events', complevel = 9)
+    else:
+        clu.save_partitions(path, 'coincident_events', coincident_events,
+                            buses_per_part)
+        clu.update_progress(progress, 1, events = number_events)
+        clu.save_partitions(path, 'events', events, buses_per_part)
+    clu.update_progress(progress, 2)
     
     triggers.to_hdf(path, 'triggers', complevel = 9)
-    print('75%')
+    clu.update_progress(progress, 3)
     
+    save_cluster_info(path, number_of_detectors, module_order, detector_types,
+                      data_set, measurement_time, E_i, calibration)
+    clu.finish_progress(progress)
+
+def save_cluster_info(path, number_of_detectors, module_order, detector_types,
+                      data_set, measurement_time, E_i, calibration):
     number_det = pd.DataFrame({'number_of_detectors': [number_of_detectors]})
     mod_or     = pd.DataFrame({'module_order': module_order})
     det_types  = pd.DataFrame({'detector_types': detector_types})
@@ -1358,11 +1536,9 @@ def save_clusters(coincident_events, events, triggers, number_of_detectors,
     mt.to_hdf(path, 'measurement_time', complevel=9)
     ei.to_hdf(path, 'E_i', complevel=9)
     ca.to_hdf(path, 'calibration', complevel=9)
-    print('100%')
-    print('Done!')
     
 def export_clusters(coincident_events, triggers, data_sets):
-    print('Exporting...')
+    progress = clu.create_progress('Exporting', 4, 'files')
     mw_min = 0
     mw_max = 10
     mg_min = 0
@@ -1375,20 +1551,18 @@ def export_clusters(coincident_events, triggers, data_sets):
     
        
     folder = get_output_path(data_sets)
-    print('0%')
     ce_path = folder + 'coincident_events.dat'
     np.savetxt(ce_path, np_matrix, delimiter=",")
-    print('25%')
+    clu.update_progress(progress, 1, events = temp_ce.shape[0])
     ToF_path = folder + 'ToF.dat'
     np.savetxt(ToF_path, temp_ce['ToF'], delimiter=",")
-    print('50%')
+    clu.update_progress(progress, 2)
     trigpath = folder + 'triggers.dat'
     np.savetxt(trigpath, triggers, delimiter=",")
-    print('75%')
+    clu.update_progress(progress, 3)
     stamppath = folder + 'timestamps.dat'
     np.savetxt(stamppath, temp_ce['Time'], delimiter=",")
-    print('100%')
-    print('Done!')
+    clu.finish_progress(progress)
     
 def get_output_path(data_set):
     dirname = os.path.dirname(__file__)
@@ -1410,8 +1584,12 @@ def intro_meny():
         print('1. Import and cluster')
         print('2. Load saved clusters')
         print('3. Unzip file(s)')
+        print('4. Follow file being recorded')
+        print('5. Receive data over socket')
+        print('6. Pre-scan file(s)')
+        print('7. Cluster and save run(s) larger than memory')
         print()
-        print('Enter a number between 1-3.')
+        print('Enter a number between 1-7.')
         ans = input('>> ')
         ans = int(ans)
     
@@ -1421,12 +1599,22 @@ def intro_meny():
             isDone = True
         elif ans == 3:
             unzip_meny()
+        elif ans == 4 or ans == 5:
+            isDone = True
+        elif ans == 6:
+            prescan_meny()
+        elif ans == 7:
+            out_of_core_meny()
         
         print()
     
     
     if ans == 1:
         return 'n'
+    elif ans == 4:
+        return 'f'
+    elif ans == 5:
+        return 's'
     else:
         return 'y'
             
@@ -1452,9 +1640,9 @@ def unzip_meny():
     if len(to_unzip) == 1 and to_unzip[0] == len(zips)+1:
         to_unzip = np.arange(1,len(zips)+1,1)
     
-    print('Unzipping...')
-    print('0%')
-    for index in to_unzip:
+    progress = clu.create_progress('Unzipping', len(to_unzip), 'files')
+    bytes_read = 0
+    for count, index in enumerate(to_unzip):
         zip_file = zips[index-1]
         zip_path = zip_folder + zip_file
 
@@ -1471,13 +1659,135 @@ def unzip_meny():
             
             source      = zip_temp_folder + source_file
             destination = os.path.join(dirname, '../Data/') + zip_file
+            bytes_read += os.path.getsize(zip_path)
             shutil.move(source, destination)
             shutil.rmtree(zip_temp_folder, ignore_errors=True)
         
-        percentage_finished = str(int(round((index/len(to_unzip))*100,1))) + '%'
-        print(percentage_finished)
+        clu.update_progress(progress, count + 1, bytes_read = bytes_read)
     
-    print('Done!')
+    clu.finish_progress(progress)
+
+def prescan_meny():
+    dirname = os.path.dirname(__file__)
+    data_files = os.listdir(os.path.join(dirname, '../Data/'))
+    data_files = [file for file in data_files if file[-9:] != '.DS_Store' 
+                  and file != '.gitignore' and file[-8:] != '.idx.npz']
+    zips = os.listdir(os.path.join(dirname, '../Zips/'))
+    data_files.extend([Zip for Zip in zips if Zip[-4:] == '.zip' 
+                       and Zip not in data_files])
+    print()
+    print('************ Choose file(s) to scan *************')
+    print('-------------------------------------------------')
+    for i, file in enumerate(data_files):
+        print(str(i+1) + '. ' + file)
+    print('-------------------------------------------------')
+    print(  '\nEnter a numbers between 1-' + str(len(data_files)) 
+          + ' to chooose\nfile(s). Use spaces to separate choices.')
+    to_scan = [int(x) for x in input('>> ').split()]
+    
+    for index in to_scan:
+        data_file = data_files[index-1]
+        print('\nScanning ' + data_file + '...')
+        summary = clu.scan_file(data_file)
+        duration = summary['Duration']
+        print('-------------------------------------------------')
+        print('Words           : ' + str(summary['Words']))
+        for word_type in ['Headers', 'Triggers', 'Bus starts', 'Events', 
+                          'ExTs', 'EoE', 'Other']:
+            print(word_type.ljust(16) + ': ' + str(summary[word_type]))
+        print('First time stamp: ' + str(summary['First time']))
+        print('Last time stamp : ' + str(summary['Last time']))
+        print('Duration        : ' + str(round(duration, 4)) + ' seconds')
+        print('Glitch readouts : ' + str(len(summary['Glitch times'])))
+        print('Glitch bursts   : ' + str(summary['Glitch bursts']))
+        events_per_bus = summary['Events per channel'].sum(axis=1)
+        for bus in np.flatnonzero(events_per_bus):
+            channels = summary['Events per channel'][bus]
+            wires = channels[0:80].sum()
+            grids = channels[80:120].sum()
+            rate = 0
+            if duration > 0:
+                rate = events_per_bus[bus] / duration
+            print('Bus ' + str(bus) + ': ' + str(round(rate, 1)) 
+                  + ' [events/s], Events: ' + str(events_per_bus[bus]) 
+                  + ' (Wire events: ' + str(wires) + '; Grid events: ' 
+                  + str(grids) + ')')
+    
+    input('\nPress "Enter" when done.\n>> ')
+
+def out_of_core_meny():
+    dirname = os.path.dirname(__file__)
+    data_files = os.listdir(os.path.join(dirname, '../Data/'))
+    data_files = [file for file in data_files if file[-9:] != '.DS_Store' 
+                  and file != '.gitignore' and file[-8:] != '.idx.npz']
+    zips = os.listdir(os.path.join(dirname, '../Zips/'))
+    data_files.extend([Zip for Zip in zips if Zip[-4:] == '.zip' 
+                       and Zip not in data_files])
+    print()
+    print('*********** Choose file(s) to cluster ***********')
+    print('-------------------------------------------------')
+    for i, file in enumerate(data_files):
+        print(str(i+1) + '. ' + file)
+    print('-------------------------------------------------')
+    print(  '\nEnter a numbers between 1-' + str(len(data_files)) 
+          + ' to chooose\nfile(s). Use spaces to separate choices.')
+    data_sets = [data_files[int(x)-1] for x in input('>> ').split()]
+    
+    print('Use standard module order and detector types (y/n)?')
+    answer = input('>> ')
+    if answer == 'y':
+        number_of_detectors = 3
+        module_order = [0,1,2,3,4,5,6,7,8]
+        detector_types = ['ILL', 'ESS', 'ESS']
+        exceptions = [0,1,2]
+    else:
+        number_of_detectors, module_order = choose_number_modules()
+        detector_types, exceptions = initialise_detector_types(number_of_detectors)
+        print()
+    
+    print('Enter amount of memory in MB to use for clustering.')
+    memory_budget = input('>> ')
+    memory_budget = float(memory_budget)
+    
+    print('Keep only coincident events (y/n)?')
+    ce_ans = input('>> ')
+    keep_events = True
+    if ce_ans == 'y':
+        keep_events = False
+    
+    print('Discard glitch readouts before saving (y/n)?')
+    glitch_ans = input('>> ')
+    discard_glitches = False
+    if glitch_ans == 'y':
+        discard_glitches = True
+    
+    print('Save clusters in one table (1), per bus (2) or per detector (3)?')
+    partition_ans = input('>> ')
+    buses_per_part = {'1': None, '2': 1, '3': 3}[partition_ans]
+    E_i, calibration = choose_E_i_and_calibration()
+    
+    data_set = data_sets
+    if len(data_sets) > 1:
+        data_set = [data_sets[0], '...']
+    data_set = str(data_set)
+    path = os.path.join(dirname, '../Clusters/') + data_set + '.h5'
+    
+    statistics = {}
+    measurement_time = clu.cluster_data_to_file(data_sets, path, exceptions,
+                                                E_i, calibration, 
+                                                memory_budget, keep_events,
+                                                statistics=statistics,
+                                                discard_glitches=
+                                                discard_glitches,
+                                                buses_per_part=buses_per_part)
+    save_cluster_info(path, number_of_detectors, module_order, detector_types,
+                      data_set, measurement_time, E_i, calibration)
+    print('Measurement time: ' + str(measurement_time))
+    print('Read: ' + str(round(statistics['Read rate'] * 4e-6, 1)) + ' MB/s, '
+          + 'clustered: ' + str(round(statistics['Cluster rate'] * 4e-6, 1))
+          + ' MB/s')
+    print('Clusters saved to ' + path + ', load them with option 2.')
+    input('\nPress "Enter" when done.\n>> ')
 
 def perspectives_animation(coincident_events, data_sets, start, stop, step):
     tof_vec = range(start, stop, step)
@@ -1902,20 +2212,18 @@ if answer == 'y':
     
     clu_path = clusters_folder + clu_set
     
-    print('Loading...')
-    print('0%')
-    coincident_events = pd.read_hdf(clu_path, 'coincident_events')
-    print('25%')
-    events = pd.read_hdf(clu_path, 'events')
-    print('50%')
+    progress = clu.create_progress('Loading', 4, 'tables')
+    coincident_events = clu.read_clusters(clu_path, 'coincident_events')
+    clu.update_progress(progress, 1, events = coincident_events.shape[0])
+    events = clu.read_clusters(clu_path, 'events')
+    clu.update_progress(progress, 2)
     triggers = pd.read_hdf(clu_path, 'triggers')
-    print('75%')
+    clu.update_progress(progress, 3)
     number_of_detectors = pd.read_hdf(clu_path, 'number_of_detectors')['number_of_detectors'].iloc[0]
     module_order_df = pd.read_hdf(clu_path, 'module_order')
     detector_types_df = pd.read_hdf(clu_path, 'detector_types')
     E_i = pd.read_hdf(clu_path, 'E_i')['E_i'].iloc[0]
-    print('100%')
-    print('Done!')
+    clu.finish_progress(progress, bytes_read = os.path.getsize(clu_path))
     
     detector_types = []
     for row in detector_types_df['detector_types']:
@@ -1929,14 +2237,26 @@ if answer == 'y':
     measurement_time = pd.read_hdf(clu_path, 'measurement_time')['measurement_time'].iloc[0]
     calibration = pd.read_hdf(clu_path, 'calibration')['calibration'].iloc[0]
     create_plot_folder(data_sets)
+    coincident_events, events = clu.compact_clusters(coincident_events, events)
     coincident_events.reset_index(drop=True, inplace=True)
     events.reset_index(drop=True, inplace=True)
     triggers.reset_index(drop=True, inplace=True)
 
+elif answer == 'f' or answer == 's':
+    folder = os.path.join(dirname, '../Data/')
+    files = os.listdir(folder)
+    files = [file for file in files if file[-9:] != '.DS_Store' and file != '.gitignore'
+             and file[-8:] != '.idx.npz']
+    coincident_events, events, data_sets, triggers, number_of_detectors, module_order, detector_types, measurement_time, E_i, calibration = follow_data_set(answer)
+    create_plot_folder(data_sets)
+
 else:
     folder = os.path.join(dirname, '../Data/')
     files = os.listdir(folder)
-    files = [file for file in files if file[-9:] != '.DS_Store' and file != '.gitignore']
+    files = [file for file in files if file[-9:] != '.DS_Store' and file != '.gitignore'
+             and file[-8:] != '.idx.npz']
+    zips = os.listdir(os.path.join(dirname, '../Zips/'))
+    files.extend([Zip for Zip in zips if Zip[-4:] == '.zip' and Zip not in files])
     coincident_events, events, data_sets, triggers, number_of_detectors, module_order, detector_types, measurement_time, E_i, calibration = choose_data_set()
     create_plot_folder(data_sets)
 
@@ -1954,9 +2274,12 @@ while not_done:
     elif choice == 3:
         animation_menu(coincident_events, data_sets, E_i, measurement_time)
     elif choice == 4:
+        print('Save clusters in one table (1), per bus (2) or per detector (3)?')
+        partition_ans = input('>> ')
+        buses_per_part = {'1': None, '2': 1, '3': 3}[partition_ans]
         save_clusters(coincident_events, events, triggers, number_of_detectors,
                       module_order, detector_types, data_sets, 
-                      measurement_time, E_i, calibration)
+                      measurement_time, E_i, calibration, buses_per_part)
     elif choice == 5:
         export_clusters(coincident_events, triggers, data_sets)
     elif choice == 6:
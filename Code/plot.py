@@ -11,6 +11,7 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 import os
 import pandas as pd
 import numpy as np
+import cluster as clu
 import matplotlib.pyplot as plt
 from matplotlib.colors import LogNorm
 from matplotlib.colors import Normalize
@@ -38,7 +39,7 @@ def plot_PHS_bus_channel(df, bus, Channel):
 def plot_PHS_several_channels(fig, name, df, bus, ChVec, data_set, 
                               loglin, count_range):
     fig1 = fig
-    df_red = df[df.Bus == bus]
+    df_red = get_bus(df, bus)
     
     for Channel in ChVec:
         df_ch = df_red[df_red.Channel == Channel]
@@ -64,7 +65,7 @@ def plot_PHS_several_channels(fig, name, df, bus, ChVec, data_set,
 
 def plot_PHS(df, bus, loc, number_of_detectors, fig, count_range = [1, 3000],
              buses_per_row = 3):
-    df_red = df[df.Bus == bus]
+    df_red = get_bus(df, bus)
     plt.subplot(1*number_of_detectors, buses_per_row, loc+1)
     plt.hist2d(df_red.Channel, df_red.ADC, bins=[120, 120], norm=LogNorm(), 
                range=[[-0.5, 119.5], [0, 4400]], vmin=count_range[0], 
@@ -112,7 +113,7 @@ def plot_PHS_buses(fig, name, df, bus_vec, data_set, count_range):
 # =============================================================================  
 
 def plot_3D_new(fig, name, df, bus, data_set):    
-    df_red = df[df.Bus == bus]
+    df_red = get_bus(df, bus)
                     
     histW, xbinsW, ybinsW, imW = plt.hist2d(df_red.Channel, df_red.ADC,
                                         bins=[80, 50], range=[[0, 79], 
@@ -214,7 +215,7 @@ def plot_2D_hit_buses(fig, name, clusters, bus_vec, number_of_detectors,
     fig.set_figheight(4 * number_of_detectors)
     fig.set_figwidth(figwidth)
     for loc, bus in enumerate(bus_vec):
-        df_clu = clusters[clusters.Bus == bus]
+        df_clu = get_bus(clusters, bus)
         plot_2D_hit(df_clu, bus, number_of_detectors, loc, fig, count_range, 
                     buses_per_row, ADC_filter)
     plt.tight_layout()
@@ -237,7 +238,7 @@ def plot_all_sides_3D(fig, name, coincident_events, bus_order, countThres, alpha
     df_tot = pd.DataFrame()
     
     for i, bus in enumerate(bus_order):
-        df_clu = coincident_events[coincident_events.Bus == bus]
+        df_clu = get_bus(coincident_events, bus)
         df_clu = df_clu[(df_clu.wCh != -1) & (df_clu.gCh != -1)]
         
         if ADC_filter != None:
@@ -246,7 +247,8 @@ def plot_all_sides_3D(fig, name, coincident_events, bus_order, countThres, alpha
             df_clu = df_clu[  (df_clu.wADC >= minADC) & (df_clu.wADC <= maxADC) 
                             & (df_clu.gADC >= minADC) & (df_clu.gADC <= maxADC)]
             
-        df_clu['wCh'] += (80 * i)
+        # Channels of several buses do not fit in the int8 'wCh' column
+        df_clu['wCh'] = df_clu['wCh'].astype(int) + (80 * i)
         df_tot = pd.concat([df_tot, df_clu])
     
     if m_range != None:
@@ -374,7 +376,7 @@ def plot_2D_side_1(bus_vec, df, fig, number_of_detectors, count_range,
     locs = []
     ticks = []
     for i, bus in enumerate(bus_vec):
-        df_clu = df[df.Bus == bus]
+        df_clu = get_bus(df, bus)
         df_clu = df_clu[(df_clu.wCh != -1) & (df_clu.gCh != -1)]
         
         if ADC_filter != None:
@@ -383,7 +385,7 @@ def plot_2D_side_1(bus_vec, df, fig, number_of_detectors, count_range,
             df_clu = df_clu[  (df_clu.wADC >= minADC) & (df_clu.wADC <= maxADC) 
                             & (df_clu.gADC >= minADC) & (df_clu.gADC <= maxADC)]
             
-        df_clu['wCh'] += (80 * i) + (i // 3) * 80
+        df_clu['wCh'] = df_clu['wCh'].astype(int) + (80 * i) + (i // 3) * 80
         df_clu['gCh'] += (-80 + 1)
         df_tot = pd.concat([df_tot, df_clu])
     
@@ -408,7 +410,7 @@ def plot_2D_side_2(bus_vec, df, fig, number_of_detectors, count_range,
     df_tot = pd.DataFrame()
 
     for i, bus in enumerate(bus_vec):
-        df_clu = df[df.Bus == bus]
+        df_clu = get_bus(df, bus)
         df_clu = df_clu[(df_clu.wCh != -1) & (df_clu.gCh != -1)]
         
         if ADC_filter != None:
@@ -417,7 +419,7 @@ def plot_2D_side_2(bus_vec, df, fig, number_of_detectors, count_range,
             df_clu = df_clu[  (df_clu.wADC >= minADC) & (df_clu.wADC <= maxADC) 
                             & (df_clu.gADC >= minADC) & (df_clu.gADC <= maxADC)]
         
-        df_clu['wCh'] += (80 * i) + (i // 3) * 80
+        df_clu['wCh'] = df_clu['wCh'].astype(int) + (80 * i) + (i // 3) * 80
         
         df_tot = pd.concat([df_tot, df_clu])  
     
@@ -443,7 +445,7 @@ def plot_2D_side_3(bus_vec, df, fig, number_of_detectors, count_range,
     df_tot = pd.DataFrame()
     
     for i, bus in enumerate(bus_vec):
-        df_clu = df[df.Bus == bus]
+        df_clu = get_bus(df, bus)
         df_clu = df_clu[(df_clu.wCh != -1) & (df_clu.gCh != -1)]
         
         if ADC_filter != None:
@@ -518,7 +520,7 @@ def plot_all_sides(fig, name, bus_vec, df, data_set, number_of_detectors,
     
 def plot_2D_multiplicity(coincident_events, number_of_detectors, bus, loc, 
                          fig, m_range, count_range, ADC_filter, buses_per_row):
-    df_clu = coincident_events[coincident_events.Bus == bus]
+    df_clu = get_bus(coincident_events, bus)
     
     if ADC_filter != None:
             minADC = ADC_filter[0]
@@ -605,8 +607,9 @@ def plot_2D_multiplicity_buses(fig, name, coincident_events, module_order,
 def charge_scatter(df, bus, number_of_detectors, loc, fig, minWM, 
                    maxWM, minGM, maxGM, exclude_channels, buses_per_row):
 
-    df_red = df[(df.Bus == bus) & (df.gM >= minWM) &
-                (df.wM <= maxWM) & (df.gM >= minGM) & (df.gM <= maxGM)]
+    df_red = get_bus(df, bus)
+    df_red = df_red[(df_red.gM >= minWM) & (df_red.wM <= maxWM)
+                    & (df_red.gM >= minGM) & (df_red.gM <= maxGM)]
     
     for Channel in exclude_channels:
         if Channel < 80:
@@ -652,7 +655,7 @@ def plot_charge_scatter_buses(fig, name, df, bus_order, number_of_detectors, dat
     fig.set_figheight(4 * number_of_detectors)
     fig.set_figwidth(figwidth)
     for loc, bus in enumerate(bus_order):
-        df_clu = df[df.Bus == bus]
+        df_clu = get_bus(df, bus)
         charge_scatter(df_clu, bus, number_of_detectors, loc, fig, minWM, maxWM, 
                        minGM, maxGM, exclude_channels, buses_per_row)
 
@@ -796,7 +799,7 @@ def plot_event_count(fig, name, module_order, number_of_detectors, data_set, eve
             maxADC = ADC_filter[1]
             events = events[(events.ADC >= minADC) & (events.ADC <= maxADC)]
         
-        plt.hist(events[events.Bus == bus].Channel, range= [-0.5,119.5], 
+        plt.hist(get_bus(events, bus).Channel, range= [-0.5,119.5], 
                  bins=120, log=log, color = 'b')
         plt.xlabel('Channel [a.u.]')
         plt.ylabel('Number of events [a.u.]')
@@ -867,20 +870,12 @@ def dE_histogram(fig, name, df, data_set, E_i, calibration, measurement_time,
     dE_range = [-E_i, E_i]
     plt.grid(True, which='major', zorder=0)
     plt.grid(True, which='minor', linestyle='--',zorder=0)
-    t_off = get_t_off(calibration) * np.ones(df.shape[0])
-    T_0 = get_T0(calibration, E_i) * np.ones(df.shape[0])
-    frame_shift = get_frame_shift(E_i) * np.ones(df.shape[0])
-    E_i = E_i * np.ones(df.shape[0])
-    ToF = df.ToF.values
-    d = df.d.values
-    dE, t_f = get_dE(E_i, ToF, d, T_0, t_off, frame_shift)
-    df_temp_new = pd.DataFrame(data={'dE': dE, 't_f': t_f})
-    df_temp_new = df_temp_new[df_temp_new['t_f'] > 0]
-    hist_MG, bins = np.histogram(df_temp_new.dE, bins=dE_bins, range=dE_range)
+    dE = get_dE(df, E_i, calibration)
+    hist_MG, bins = np.histogram(dE, bins=dE_bins, range=dE_range)
     bin_centers = 0.5 * (bins[1:] + bins[:-1])
     
     plt.xlabel('$\Delta$E [meV]')
-    plt.xlim([-E_i[0], E_i[0]])
+    plt.xlim([-E_i, E_i])
     plt.ylim([1, 1.2 * max(hist_MG)])
     plt.ylabel('Counts')
     plt.yscale('log')
@@ -888,8 +883,8 @@ def dE_histogram(fig, name, df, data_set, E_i, calibration, measurement_time,
     lim_ToF_vec = None
     isPureAluminium = False
     
-    hist_background = plot_dE_background(E_i[0], calibration, measurement_time, 
-                                         1, -E_i[0], E_i[0], back_yes, 1,
+    hist_background = plot_dE_background(E_i, calibration, measurement_time, 
+                                         1, -E_i, E_i, back_yes, 1,
                                          isPureAluminium, lim_ToF_vec)
     
     if back_yes is False:
@@ -1692,15 +1687,7 @@ def RRM(fig, name, df, data_set, border, E_i_vec, measurement_time,
         plt.subplot(2,2,i+1)
         df_temp = df_vec[i]
         calibration = 'Van__3x3_RRM_Calibration_' + str(E_i)
-        t_off = get_t_off(calibration) * np.ones(df_temp.shape[0])
-        T_0 = get_T0(calibration, E_i) * np.ones(df_temp.shape[0])
-        frame_shift = get_frame_shift(E_i) * np.ones(df_temp.shape[0])
-        E_i = E_i * np.ones(df_temp.shape[0])
-        ToF = df_temp.ToF.values
-        d = df_temp.d.values
-        dE, t_f = get_dE(E_i, ToF, d, T_0, t_off, frame_shift)
-        df_temp_new = pd.DataFrame(data={'dE': dE, 't_f': t_f})
-        df_temp_new = df_temp_new[df_temp_new['t_f'] > 0]
+        dE = get_dE(df_temp, E_i, calibration)
     
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--',zorder=0)
@@ -1708,14 +1695,14 @@ def RRM(fig, name, df, data_set, border, E_i_vec, measurement_time,
         MG_norm = 1
         tot_norm = 1
  
-        MG_back_dE_hist = plot_dE_background(E_i[0], calibration, measurement_time, 
-                                             MG_norm, -E_i[0], E_i[0], back_yes, tot_norm,
+        MG_back_dE_hist = plot_dE_background(E_i, calibration, measurement_time, 
+                                             MG_norm, -E_i, E_i, back_yes, tot_norm,
                                              isPureAluminium, lim_ToF_vec[i])
         
         
         
-        MG_dE_hist, bins = np.histogram(df_temp_new.dE, bins=dE_bins, 
-                                      range=[-E_i[0], E_i[0]])
+        MG_dE_hist, bins = np.histogram(dE, bins=dE_bins, 
+                                      range=[-E_i, E_i])
         bin_centers = 0.5 * (bins[1:] + bins[:-1])
         
         
@@ -1723,7 +1710,7 @@ def RRM(fig, name, df, data_set, border, E_i_vec, measurement_time,
             MG_dE_hist = MG_dE_hist - MG_back_dE_hist
         
         plt.plot(bin_centers, MG_dE_hist, '-', color=color_vec[i], 
-                 label = str(E_i[0]) + ' meV')
+                 label = str(E_i) + ' meV')
                 
         
         
@@ -1831,15 +1818,7 @@ def plot_He3_data(fig, df, data_set, calibration, measurement_time, E_i, FWHM,
                 & (df.gCh != 99) & (df.gCh != 101)]
     
     # Calculate MG spectrum
-    t_off = get_t_off(calibration) * np.ones(df.shape[0])
-    T_0 = get_T0(calibration, E_i) * np.ones(df.shape[0])
-    frame_shift = get_frame_shift(E_i) * np.ones(df.shape[0])
-    E_i = E_i * np.ones(df.shape[0])
-    ToF = df.ToF.values
-    d = df.d.values
-    dE, t_f = get_dE(E_i, ToF, d, T_0, t_off, frame_shift)
-    df_temp = pd.DataFrame(data={'dE': dE, 't_f': t_f})
-    dE = df_temp[df_temp['t_f'] > 0].dE
+    dE = get_dE(df, E_i, calibration)
     # Get MG dE histogram
     dE_bins = 390
     dE_range = [he3_min, he3_max]
@@ -1874,7 +1853,7 @@ def plot_He3_data(fig, df, data_set, calibration, measurement_time, E_i, FWHM,
     if calibration[0:30] == 'Van__3x3_High_Flux_Calibration':
         print('High Flux')
         print(calibration)
-        if E_i[0] < 450:
+        if E_i < 450:
             MG_solid_angle = (MG_solid_angle_tot - MG_missing_solid_angle_1
                               - MG_missing_solid_angle_2)
         else:
@@ -1882,7 +1861,7 @@ def plot_He3_data(fig, df, data_set, calibration, measurement_time, E_i, FWHM,
     else:
         print('High Resolution')
         print(calibration)
-        if E_i[0] > 50:
+        if E_i > 50:
             MG_solid_angle = (MG_solid_angle_tot - MG_missing_solid_angle_1
                               - MG_missing_solid_angle_2)
         else:
@@ -1900,7 +1879,7 @@ def plot_He3_data(fig, df, data_set, calibration, measurement_time, E_i, FWHM,
         tot_norm = sum(MG_dE_hist)/sum(He3_dE_hist)
     
     # Plot background level
-    hist_back = plot_dE_background(E_i[0], calibration, measurement_time, 
+    hist_back = plot_dE_background(E_i, calibration, measurement_time, 
                                    norm_MG, he3_min, he3_max, back_yes, 
                                    tot_norm, isPureAluminium)
 
@@ -1949,7 +1928,7 @@ def plot_He3_data(fig, df, data_set, calibration, measurement_time, E_i, FWHM,
     He3_hist_max = max(He3_dE_hist)
     MG_hist_max = max(MG_dE_hist)
     tot_max = max([He3_hist_max, MG_hist_max])
-    plt.text(-0.7*E_i[0], tot_max * 0.07, text_string, ha='center', va='center', 
+    plt.text(-0.7*E_i, tot_max * 0.07, text_string, ha='center', va='center', 
                  bbox={'facecolor':'white', 'alpha':0.9, 'pad':10}, fontsize=6,
                  zorder=50)
     
@@ -1994,7 +1973,7 @@ def ToF_per_voxel(df, data_set, Bus):
     df = df[(df.wADC > 500) & (df.gADC > 400)]
     df = df[(df.wM == 1) & (df.gM <= 5)]
     df = df[df.Time < 1.5e12]
-    df = df[df.Bus == Bus]
+    df = get_bus(df, Bus)
     folder = get_plot_path(data_set)
     grids = range(80,120)
     for i, grid in enumerate(grids):
@@ -2575,6 +2554,22 @@ def get_output_path(data_set):
 def import_helium_tubes():
     pass
 
+def get_bus(df, bus):
+    """ Returns the rows of 'df' on 'bus'. 'df' is either a whole table, or
+        its parts from 'partition_by_bus' or 'load_partitions' in cluster.py,
+        in which case the part of the bus is looked up directly instead of 
+        going through the whole table.
+    """
+    if not isinstance(df, dict):
+        return df[df.Bus == bus]
+    if bus in df:
+        return df[bus]
+    for key, part in df.items():
+        if isinstance(key, tuple) and bus in key:
+            return part[part.Bus == bus]
+    part = next(iter(df.values()), pd.DataFrame(columns=['Bus']))
+    return part.iloc[0:0]
+
 def filter_clusters(df):
     df = df[df.d != -1]
     df = df[df.tf > 0]
@@ -2612,22 +2607,15 @@ def get_dE_He3(E_i, ToF, d, T_0, t_off):
     
 
 
-def get_dE(E_i, ToF, d, T_0, t_off, frame_shift):
-    # Declare parameters
-    L_1 = 20.01                                # Target-to-sample distance
-    m_n = 1.674927351e-27                      # Neutron mass [kg]
-    meV_to_J = 1.60218e-19 * 0.001             # Convert meV to J
-    J_to_meV = 6.24150913e18 * 1000            # Convert J to meV
-    # Calculate dE
-    E_i_J = E_i * meV_to_J                     # Convert E_i from meV to J
-    v_i = np.sqrt((E_i_J*2)/m_n)               # Get velocity of E_i
-    t_1 = (L_1 / v_i) + T_0 * 1e-6             # Use velocity to find t_1
-    ToF_real = ToF * 62.5e-9 + (t_off * 1e-6)  # Time from source to detector
-    ToF_real += frame_shift                    # Apply frame-shift
-    t_f = ToF_real - t_1                       # Time from sample to detector
-    E_J = (m_n/2) * ((d/t_f) ** 2)             # Energy E_f in Joule
-    E_f = E_J * J_to_meV                       # Convert to meV
-    return (E_i - E_f), t_f
+def get_dE(df, E_i, calibration):
+    """ Returns E_i - E_f of the coincident events in 'df' which reach the
+        detector after the sample (t_f > 0). The 'dE' and 'tf' columns added
+        by 'clu.add_energy_transfer' are used when they were calculated for
+        the same E_i and calibration, otherwise they are calculated here.
+    """
+    if df.attrs.get('energy_transfer') != (E_i, calibration):
+        df = clu.add_energy_transfer(df.copy(), E_i, calibration)
+    return df[df.tf > 0].dE.values
     
 
 def import_T0_table():
@@ -2671,59 +2659,6 @@ def get_t_off(calibration):
     return t_off_table[calibration]
 
 
-def get_frame_shift(E_i):
-    frame_shift = 0
-    if E_i == 2:
-        frame_shift += 2 * (16666.66666e-6) - 0.0004475
-    if E_i == 3:
-        frame_shift += 2 * (16666.66666e-6) - 0.00800875
-    if E_i == 4:
-        frame_shift += 2 * (16666.66666e-6) - 0.0125178125
-    if E_i == 5:
-        frame_shift += 2 * (16666.66666e-6) - 0.015595
-    if E_i == 6:
-        frame_shift += (16666.66666e-6) - 0.001190399
-    if E_i == 7:
-        frame_shift += (16666.66666e-6) - 0.002965625
-    if E_i == 8:
-        frame_shift += (16666.66666e-6) - 0.0043893
-    if E_i == 9:
-        frame_shift += (16666.66666e-6) - 0.0055678125
-    if E_i == 10:
-        frame_shift += (16666.66666e-6) - 0.0065653125
-    if E_i == 12:
-        frame_shift += (16666.66666e-6) - 0.00817125
-    if E_i == 14:
-        frame_shift += (16666.66666e-6) - 0.00942
-    if E_i == 15:
-        frame_shift += (16666.66666e-6) - 0.009948437499999999
-    if E_i == 16:
-        frame_shift += (16666.66666e-6) - 0.01042562499
-    if E_i == 18:
-        frame_shift += (16666.66666e-6) - 0.011259375
-    if E_i == 21:
-        frame_shift += (16666.66666e-6) - 0.01227875
-    if E_i == 20:
-        frame_shift += (16666.66666e-6) - 0.011965
-    if E_i == 25:
-        frame_shift += (16666.66666e-6) - 0.013340625
-    if E_i == 30:
-        frame_shift += (16666.66666e-6) - 0.01435625
-    if E_i == 32:
-        frame_shift += (16666.66666e-6) - 0.014646875
-    if E_i == 34:
-        frame_shift += (16666.66666e-6) - 0.015009375
-    if E_i == 35:
-        frame_shift += (16666.66666e-6) - 0.01514625
-    if E_i == 40:
-        frame_shift += (16666.66666e-6) - 0.0157828125
-    if E_i == 40.8:
-        frame_shift += (16666.66666e-6) - 0.015878125
-    if E_i == 48:
-        frame_shift += (16666.66666e-6) - 0.0165909375
-    return frame_shift
-
-
 def find_He3_measurement_id(calibration):
     dirname = os.path.dirname(__file__)
     path = os.path.join(dirname, '../Tables/experiment_log.xlsx')
@@ -2906,15 +2841,7 @@ def plot_dE_background(E_i, calibration, measurement_time,
     end_time = df.tail(1)['Time'].values[0]
     duration = (end_time - start_time) * 62.5e-9
     # Calculate background
-    t_off = get_t_off(calibration) * np.ones(df.shape[0])
-    T_0 = get_T0(calibration, E_i) * np.ones(df.shape[0])
-    frame_shift = get_frame_shift(E_i) * np.ones(df.shape[0])
-    E_i = E_i * np.ones(df.shape[0])
-    ToF = df.ToF.values
-    d = df.d.values
-    dE, t_f = get_dE(E_i, ToF, d, T_0, t_off, frame_shift)
-    df_temp = pd.DataFrame(data={'dE': dE, 't_f': t_f})
-    dE = df_temp[df_temp['t_f'] > 0].dE
+    dE = get_dE(df, E_i, calibration)
     # Calculate weights
     number_of_events = len(dE)
     events_per_s = number_of_events / duration
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Replays a recorded '.mesytec'-file over a local TCP or UDP socket, at a
+configurable rate, so that the socket ingest in 'cluster.receive_data' can be
+tested without a DAQ attached.
+
+@author: alexanderbackis
+"""
+
+# =======  LIBRARIES  ======= #
+import socket
+import time
+import cluster as clu
+
+
+def replay_data(file_name, rate = 10, port = 5555, host = 'localhost',
+                protocol = 'tcp', piece_size = 1 << 10):
+    """ Sends the words in the '.mesytec'-file 'file_name' in '/Data/' to
+        'host':'port', without the configuration text. Pieces of 'piece_size'
+        words are sent, and the sending is paused between pieces so that on
+        average at most 'rate' MB/s are sent. A UDP replay ends with an empty
+        datagram, a TCP replay by closing the connection.
+        
+    Args:
+        file_name (str): Name of '.mesytec'-file that contains the data
+        rate (float): Maximum rate in MB/s
+        port (int): Port to send to
+        host (str): Address to send to
+        protocol (str): 'tcp' or 'udp'
+        piece_size (int): Number of words per piece (datagram)
+            
+    """
+    if protocol == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send = lambda content: sock.sendto(content, (host, port))
+    else:
+        sock = socket.create_connection((host, port))
+        send = sock.sendall
+    
+    print('Replaying...')
+    start_time = time.time()
+    bytes_sent = 0
+    with sock:
+        for chunk in clu.import_data_chunks(file_name):
+            for start in range(0, len(chunk), piece_size):
+                content = chunk[start:start+piece_size].tobytes()
+                send(content)
+                bytes_sent += len(content)
+                ahead = bytes_sent / (rate * (1 << 20)) - (time.time() - start_time)
+                if ahead > 0:
+                    time.sleep(ahead)
+        if protocol == 'udp':
+            send(b'')
+    
+    duration = time.time() - start_time
+    print('Sent ' + str(round(bytes_sent / (1 << 20), 2)) + ' MB in ' 
+          + str(round(duration, 2)) + ' s')
+    print('Done!')
+
+
+if __name__ == '__main__':
+    file_name = input('File in /Data/ to replay: ')
+    rate = float(input('Rate [MB/s]: '))
+    port = int(input('Port: '))
+    protocol = input('Protocol (tcp/udp): ')
+    replay_data(file_name, rate, port, protocol=protocol)
@@ -0,0 +1,231 @@
+import socket
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cluster as clu
+
+
+# =============================================================================
+#                                SOCKET INGEST
+# =============================================================================
+
+def test_receive_data_bind_failure():
+    busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    busy.bind(('localhost', 0))
+    busy.listen(1)
+    port = busy.getsockname()[1]
+    try:
+        with pytest.raises(OSError):
+            list(clu.receive_data(port, timeout=5))
+    finally:
+        busy.close()
+
+
+# =============================================================================
+#                               BUS PARTITIONS
+# =============================================================================
+
+def create_clusters(buses):
+    return pd.DataFrame({'Bus': np.array(buses, dtype=np.int8),
+                         'Time': np.arange(len(buses), dtype=np.int64)})
+
+
+def test_save_partitions_over_single_table(tmp_path):
+    path = str(tmp_path / 'clusters.h5')
+    create_clusters([0, 0, 1]).to_hdf(path, key='coincident_events')
+    new = create_clusters([2, 3, 3, 2])
+    clu.save_partitions(path, 'coincident_events', new)
+    pd.testing.assert_frame_equal(clu.read_clusters(path, 'coincident_events'),
+                                  new)
+
+
+def test_save_partitions_twice(tmp_path):
+    path = str(tmp_path / 'clusters.h5')
+    clu.save_partitions(path, 'events', create_clusters([0, 1, 2, 1]))
+    new = create_clusters([1, 1])
+    clu.save_partitions(path, 'events', new)
+    assert list(clu.load_partitions(path, 'events').keys()) == [1]
+    pd.testing.assert_frame_equal(clu.read_clusters(path, 'events'), new)
+
+
+def test_save_single_table_over_partitions(tmp_path):
+    path = str(tmp_path / 'clusters.h5')
+    clu.save_partitions(path, 'events', create_clusters([0, 1, 2]))
+    clu.remove_clusters(path, 'events')
+    new = create_clusters([4])
+    new.to_hdf(path, key='events')
+    with pd.HDFStore(path, mode='r') as store:
+        assert store.keys() == ['/events']
+    pd.testing.assert_frame_equal(clu.read_clusters(path, 'events'), new)
+
+
+# =============================================================================
+#                                 CLUSTERING
+# =============================================================================
+
+def header(trigger=False):
+    return clu.Trigger if trigger else clu.Header
+
+
+def bus_start(bus):
+    return clu.DataBusStart | bus << clu.BusShift
+
+
+def event(channel, adc):
+    return clu.DataEvent | channel << clu.ChannelShift | adc
+
+
+def exts(value):
+    return clu.DataExTs | value
+
+
+def eoe(time):
+    return clu.EoE | time
+
+
+def create_stream():
+    words = [# Event before any bus start
+             header(), event(5, 100), eoe(10),
+             # Trigger with extended time stamp, ties for the highest wire
+             # and grid ADC, channel above 119
+             header(True), exts(1), bus_start(0), event(10, 400),
+             event(11, 400), event(3, 50), event(90, 300), event(95, 300),
+             event(125, 700), eoe(1000),
+             # Buses 1 and 2 are merged if ILL, bus 5 is not
+             header(), bus_start(1), event(20, 200), event(100, 150),
+             bus_start(2), event(21, 300), event(101, 90), bus_start(5),
+             event(40, 80), event(85, 60), eoe(2000),
+             # Events before the bus start go to the previous readout
+             header(), event(30, 500), event(110, 20), bus_start(3),
+             event(31, 100), event(82, 100), eoe(3000),
+             # New trigger and extended time stamp, only wires
+             header(True), exts(2), bus_start(4), event(0, 10),
+             event(1, 20), eoe(4000),
+             # Only grids, then a word outside of any readout
+             header(), bus_start(6), event(88, 900), eoe(5000),
+             event(7, 7),
+             # Readout still open at the end
+             header(), bus_start(7), event(12, 300), event(92, 300)]
+    return np.array(words, dtype=np.uint32)
+
+
+def cluster_chunks(cluster_function, chunks, ILL_buses, keep_events):
+    state = {}
+    histograms = clu.create_histograms()
+    results = [cluster_function(chunk, ILL_buses, state=state,
+                                keep_events=keep_events,
+                                histograms=histograms)
+               for chunk in chunks]
+    return results, state, histograms
+
+
+def assert_clusters_equal(result, expected):
+    assert len(result[0]) == len(expected[0])
+    for tables, expected_tables in zip(result[0], expected[0]):
+        for table, expected_table in zip(tables, expected_tables):
+            pd.testing.assert_frame_equal(table, expected_table)
+    assert result[1] == expected[1]
+    for key in expected[2]:
+        np.testing.assert_array_equal(result[2][key], expected[2][key])
+
+
+def test_cluster_data_stream():
+    (coincident_events, events, triggers), = cluster_chunks(
+            clu.cluster_data, [create_stream()], [1, 2], True)[0]
+    assert list(coincident_events.Bus) == [0, 2, -1, 3, 4, 6, 7]
+    assert list(coincident_events.wCh) == [11, 20, 31, 30, 0, -1, 13]
+    assert list(coincident_events.gCh) == [90, 100, 85, 82, -1, 88, 92]
+    assert list(coincident_events.wM) == [3, 2, 2, 1, 2, 0, 1]
+    assert list(coincident_events.Time[-1:]) == [0]
+    assert list(triggers[0]) == [1 << 30 | 1000, 2 << 30 | 4000]
+    assert list(events.ClusterID[:2]) == [-1, 0]
+    assert not events.Valid[6]
+
+
+@pytest.mark.parametrize('ILL_buses', [[], [1, 2]])
+@pytest.mark.parametrize('keep_events', [True, False])
+def test_cluster_data_vectorized(ILL_buses, keep_events):
+    words = create_stream()
+    for split in range(len(words) + 1):
+        chunks = [words[:split], words[split:]]
+        expected = cluster_chunks(clu.cluster_data, chunks, ILL_buses,
+                                  keep_events)
+        result = cluster_chunks(clu.cluster_data_vectorized, chunks,
+                                ILL_buses, keep_events)
+        assert_clusters_equal(result, expected)
+
+
+@pytest.mark.skipif(clu.cluster_kernel_jit is None, reason='needs Numba')
+@pytest.mark.parametrize('ILL_buses', [[], [1, 2]])
+@pytest.mark.parametrize('keep_events', [True, False])
+def test_cluster_data_jit(ILL_buses, keep_events):
+    words = create_stream()
+    for split in range(len(words) + 1):
+        chunks = [words[:split], words[split:]]
+        expected = cluster_chunks(clu.cluster_data, chunks, ILL_buses,
+                                  keep_events)
+        result = cluster_chunks(clu.cluster_data_jit, chunks, ILL_buses,
+                                keep_events)
+        assert_clusters_equal(result, expected)
+
+
+# =============================================================================
+#                                  SHARDING
+# =============================================================================
+
+@pytest.mark.parametrize('ILL_buses', [[], [1, 2]])
+def test_cluster_data_sharded(ILL_buses):
+    # Most of the equally sized parts end inside a readout, and some of them
+    # right before the readout with events before its bus start
+    words = create_stream()
+    expected = cluster_chunks(clu.cluster_data, [words], ILL_buses, True)
+    for shards in range(2, 12):
+        result = cluster_chunks(
+                lambda *args, **kwargs: clu.cluster_data_sharded(
+                        *args, shards=shards, **kwargs),
+                [words], ILL_buses, True)
+        assert_clusters_equal(result, expected)
+
+
+# =============================================================================
+#                                  GLITCHES
+# =============================================================================
+
+def create_glitch_clusters():
+    # One coincident event and one event per readout, glitches at 30, 40, 70
+    times = np.arange(0, 90, 10, dtype=np.int64)
+    is_glitch = np.isin(times, [30, 40, 70])
+    coincident_events = pd.DataFrame({'Time': times,
+                                      'wM': np.where(is_glitch, 90, 1),
+                                      'gM': np.where(is_glitch, 50, 1)})
+    events = pd.DataFrame({'Time': times,
+                           'ClusterID': np.arange(len(times))})
+    return coincident_events, events
+
+
+def test_discard_glitch_readouts():
+    coincident_events, events = create_glitch_clusters()
+    ce, e, intervals, live_time = clu.discard_glitch_readouts(
+            coincident_events, events)
+    assert list(ce.Time) == [0, 10, 20, 50, 60, 80]
+    assert list(e.Time) == [0, 10, 20, 50, 60, 80]
+    assert list(e.ClusterID) == [0, 1, 2, 3, 4, 5]
+    assert intervals.values.tolist() == [[0, 20], [50, 60], [80, 80]]
+    # Duration 80 minus 20-50 and 60-80 around the glitches
+    assert live_time == pytest.approx(30 * 62.5e-9)
+
+
+def test_discard_glitch_readouts_chunks():
+    coincident_events, events = create_glitch_clusters()
+    state = {}
+    kept = []
+    for rows in [slice(0, 2), slice(2, 4), slice(4, 6), slice(6, 9)]:
+        ce, __, __, __ = clu.discard_glitch_readouts(
+                coincident_events[rows],
+                clu.shift_cluster_ids(events[rows], -rows.start), state)
+        kept.extend(ce.Time)
+    assert kept == [0, 10, 20, 50, 60, 80]
+    assert [state['Start'], state['End']] == [80, 80]
+    assert state['Live time'] == pytest.approx(30 * 62.5e-9)